@@ -0,0 +1,122 @@
+"""
+Troceado del stream NDJSON de Ollama y extracción del campo "response".
+
+El módulo está anotado por completo para poder compilarlo con mypyc
+(`mypyc fast_ndjson.py`); si existe el módulo compilado, Python lo carga
+en lugar de este fichero sin cambiar nada en main.py.
+"""
+from typing import Any, List, Optional
+
+import orjson
+
+_simdjson: Optional[Any]
+try:
+    import simdjson  # type: ignore[import-not-found]
+    _simdjson = simdjson
+except ImportError:  # pysimdjson es opcional
+    _simdjson = None
+
+# Un único parser por proceso (es decir, por worker) para reutilizar sus
+# buffers internos entre líneas; cada parse() invalida el documento anterior
+_parser: Any = _simdjson.Parser() if _simdjson is not None else None
+
+RESPONSE_KEY = b'"response":"'
+NEWLINE = 0x0A
+BACKSLASH = 0x5C
+
+
+def extract_response(line: bytes) -> Optional[bytes]:
+    """
+    Extrae el campo "response" de una línea NDJSON sin parsear el objeto
+    completo. Devuelve None si el campo no aparece en la forma esperada.
+    """
+    start = line.find(RESPONSE_KEY)
+    if start == -1:
+        return None
+    start += len(RESPONSE_KEY)
+    end = start
+    while True:
+        end = line.find(b'"', end)
+        if end == -1:
+            return None
+        # Una comilla precedida por un número impar de barras está escapada
+        backslashes = 0
+        while line[end - 1 - backslashes] == BACKSLASH:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            break
+        end += 1
+    value = line[start:end]
+    if BACKSLASH in value:
+        return orjson.loads(b'"' + value + b'"').encode("utf-8")
+    return value
+
+
+def parse_line(line: bytes) -> Any:
+    """
+    Parsea una línea completa con pysimdjson si está instalado y, si no,
+    con orjson. Ambos lanzan ValueError ante JSON inválido. El resultado de
+    pysimdjson solo es válido hasta la siguiente llamada.
+    """
+    if _parser is not None:
+        return _parser.parse(line)
+    return orjson.loads(line)
+
+
+def response_field(line: bytes) -> Optional[bytes]:
+    """
+    Devuelve el campo "response" de una línea, recurriendo a un parseo
+    completo cuando el escaneo rápido no lo encuentra. Devuelve None si la
+    línea no es JSON válido o no contiene el campo.
+    """
+    try:
+        text = extract_response(line)
+        if text is None:
+            data = parse_line(line)
+            if "response" not in data:
+                return None
+            value = data["response"]
+            if not isinstance(value, str):
+                return None
+            text = value.encode("utf-8")
+    except (ValueError, TypeError):
+        # JSON inválido o valores que no son objetos (números, listas...)
+        return None
+    return text
+
+
+def iter_response_fields(buf: bytes) -> List[bytes]:
+    """
+    Devuelve los campos "response" no vacíos de todas las líneas de buf.
+    """
+    fields: List[bytes] = []
+    for line in buf.split(b"\n"):
+        if line.strip():
+            text = response_field(line)
+            if text:
+                fields.append(text)
+    return fields
+
+
+class Framer:
+    """
+    Acumula los bytes recibidos de la red y devuelve los campos "response"
+    de cada línea completa, conservando las líneas que llegan partidas.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        self.buffer += chunk
+        end = self.buffer.rfind(NEWLINE)
+        if end == -1:
+            return []
+        complete = bytes(self.buffer[:end])
+        del self.buffer[:end + 1]
+        return iter_response_fields(complete)
+
+    def flush(self) -> List[bytes]:
+        rest = bytes(self.buffer)
+        self.buffer.clear()
+        return iter_response_fields(rest)
@@ -1,137 +1,324 @@
 import os
-import json
+import time
+import asyncio
+import importlib.util
+import orjson
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Body
-from fastapi.responses import StreamingResponse, JSONResponse
-from pydantic import BaseModel
-from typing import List, Dict, Optional
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Optional, Tuple
 import httpx
 
-app = FastAPI()
+from fast_ndjson import Framer
 
 # Obtener la URL del servidor LLM desde una variable de entorno
 LLM_SERVER_URL = os.environ.get("LLM_SERVER_URL", "http://localhost:11434")  
 
+# httpx solo negocia HTTP/2 sobre TLS y necesita el paquete opcional h2
+HTTP2 = LLM_SERVER_URL.startswith("https://") and importlib.util.find_spec("h2") is not None
+
+# Los cuerpos se codifican con orjson y se envían ya serializados
+JSON_HEADERS = {"content-type": "application/json"}
+
+# Agrupación de tokens en el streaming: tamaño máximo y espera máxima por envío
+BATCH_BYTES = int(os.environ.get("BATCH_BYTES", 2048))
+BATCH_MS = int(os.environ.get("BATCH_MS", 8))
+
+# Límite aproximado de tokens por prompt; 0 lo desactiva
+MAX_PROMPT_TOKENS = int(os.environ.get("MAX_PROMPT_TOKENS", 0))
+
+# Caché de la respuesta de /api/tags: (instante de obtención, cuerpo en bytes)
+MODELS_CACHE_TTL = 5.0
+_models_cache: Optional[Tuple[float, bytes]] = None
+_models_lock = asyncio.Lock()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Crea un único cliente HTTP compartido por todas las peticiones para
+    reutilizar las conexiones keep-alive con el servidor LLM.
+    """
+    app.state.http = httpx.AsyncClient(
+        base_url=LLM_SERVER_URL,
+        timeout=60.0,
+        limits=httpx.Limits(
+            max_connections=200,
+            max_keepalive_connections=100,
+            keepalive_expiry=60,
+        ),
+        http2=HTTP2,
+    )
+    if MAX_PROMPT_TOKENS:
+        # Se importa solo si hace falta: numba y numpy pesan en cada worker
+        from tokens_estimate import estimate_tokens
+
+        # Compila (o carga de la caché de numba) el estimador antes de la primera petición
+        estimate_tokens("warm up")
+        app.state.estimate_tokens = estimate_tokens
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+class FixedCORSMiddleware:
+    """
+    Middleware ASGI mínimo que añade cabeceras CORS fijas a cada respuesta
+    y contesta las peticiones OPTIONS con un 204, sin comprobar orígenes.
+    """
+
+    def __init__(self, app, allow_origin: str):
+        self.app = app
+        self.headers = [(b"access-control-allow-origin", allow_origin.encode("latin-1"))]
+        self.preflight_headers = self.headers + [
+            (b"access-control-allow-methods", b"GET, POST, OPTIONS"),
+            (b"access-control-allow-headers", b"*"),
+            (b"access-control-max-age", b"600"),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if scope["method"] == "OPTIONS":
+            await send({"type": "http.response.start", "status": 204, "headers": self.preflight_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + self.headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+
+# CORS solo se activa si se define el origen permitido (por ejemplo "*")
+CORS_ALLOW_ORIGIN = os.environ.get("CORS_ALLOW_ORIGIN")
+if CORS_ALLOW_ORIGIN:
+    app.add_middleware(FixedCORSMiddleware, allow_origin=CORS_ALLOW_ORIGIN)
+
 class Query(BaseModel):
     """
     Modelo para las solicitudes a la API.
     """
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=False)
+
     prompt: str
     model: str = "llama3.2:3b"
     stream: Optional[bool] = True  # Default to streaming
+    raw: bool = False  # Reenviar el NDJSON de Ollama sin procesar
+    # Agrupación del streaming; 0 envía cada token en cuanto llega
+    batch_bytes: Optional[int] = Field(None, ge=0)
+    batch_ms: Optional[int] = Field(None, ge=0)
 
 
 
-async def stream_generated_text(prompt: str, model: str = "llama3.2:3b"):
+async def open_generation_stream(prompt: str, model: str = "llama3.2:3b") -> httpx.Response:
     """
-    Genera texto de forma asíncrona usando Mistral.
+    Abre el stream de generación con Mistral y comprueba el estado antes de
+    empezar a responder, para que los errores lleguen al cliente con su código.
     """
-    url = f"{LLM_SERVER_URL}/api/generate"
-    async with httpx.AsyncClient(timeout=60.0) as client:
+    client = app.state.http
+    # Configuración específica para Mistral
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "stream": True,
+        "options": {
+            "temperature": 0.7,
+            "top_p": 0.95,
+            "top_k": 40,
+        }
+    }
+    request = client.build_request("POST", "/api/generate", content=orjson.dumps(payload), headers=JSON_HEADERS)
+    try:
+        response = await client.send(request, stream=True)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Error de comunicación con el servidor LLM: {e}")
+
+    if response.status_code != 200:
+        # Se limita el tamaño del detalle para no cargar páginas de error enormes
         try:
-            # Configuración específica para Mistral
-            payload = {
-                "model": model,
-                "prompt": prompt,
-                "stream": True,
-                "options": {
-                    "temperature": 0.7,
-                    "top_p": 0.95,
-                    "top_k": 40,
-                }
-            }
-            
-            async with client.stream("POST", url, json=payload) as response:
-                if response.status_code != 200:
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=f"Error al conectar con el servidor LLM: {response.status_code} - {response.text}"
-                    )
-
-                async for chunk in response.aiter_bytes():
-                    decoded_chunk = chunk.decode('utf-8')
-                    for line in decoded_chunk.split("\n"):
-                        if line.strip():
-                            try:
-                                data = json.loads(line)
-                                if "response" in data:
-                                    yield data["response"]
-                            except json.JSONDecodeError:
-                                continue
+            body = await response.aread()
+        finally:
+            await response.aclose()
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Error al conectar con el servidor LLM: {response.status_code} - {body[:512].decode('utf-8', 'replace')}"
+        )
+    return response
 
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=f"Error de comunicación con el servidor LLM: {e}")
+async def stream_generated_text(response: httpx.Response, raw: bool = False):
+    """
+    Genera texto de forma asíncrona a partir del stream ya abierto.
+    Con raw=True reenvía el stream NDJSON del servidor LLM tal cual.
+    """
+    try:
+        if raw:
+            async for chunk in response.aiter_bytes():
+                yield chunk
+            return
+
+        framer = Framer()
+        async for chunk in response.aiter_bytes():
+            for text in framer.feed(chunk):
+                yield text
+        for text in framer.flush():
+            yield text
 
-async def get_generated_text(prompt: str, model: str = "llama3.2:3b"):
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Error de comunicación con el servidor LLM: {e}")
+    finally:
+        await response.aclose()
+
+async def coalesce(chunks, max_bytes: int = BATCH_BYTES, max_delay: float = BATCH_MS / 1000):
     """
-    Obtiene el texto completo generado por Mistral.
+    Agrupa los fragmentos de un generador asíncrono y los emite cuando se
+    acumulan max_bytes o pasan max_delay segundos desde el primero pendiente.
     """
-    url = f"{LLM_SERVER_URL}/api/generate"
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        try:
-            # Configuración específica para Mistral
-            payload = {
-                "model": model,
-                "prompt": prompt,
-                "stream": False,
-                "options": {
-                    "temperature": 0.7,
-                    "top_p": 0.95,
-                    "top_k": 40,
-                }
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    buffer = bytearray()
+    deadline = None
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                # La lectura no se cancela al vencer el plazo: sigue en curso
+                # y se recoge en la siguiente vuelta
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout: Optional[float] = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield bytes(buffer)
+                buffer.clear()
+                deadline = None
+                continue
+
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            buffer += chunk
+            if deadline is None:
+                deadline = loop.time() + max_delay
+            if len(buffer) >= max_bytes or loop.time() >= deadline:
+                yield bytes(buffer)
+                buffer.clear()
+                deadline = None
+
+        if buffer:
+            yield bytes(buffer)
+    finally:
+        # Cierra el generador envuelto para liberar la petición al servidor LLM
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait({pending})
+            if not pending.cancelled():
+                pending.exception()
+        await iterator.aclose()
+
+async def get_generated_text(prompt: str, model: str = "llama3.2:3b") -> Response:
+    """
+    Obtiene la respuesta completa generada por Mistral y la reenvía sin
+    volver a parsearla ni serializarla.
+    """
+    client = app.state.http
+    try:
+        # Configuración específica para Mistral
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": False,
+            "options": {
+                "temperature": 0.7,
+                "top_p": 0.95,
+                "top_k": 40,
             }
-            
-            response = await client.post(url, json=payload)
-            response.raise_for_status()
-
-            combined_response = ""
-            for line in response.text.splitlines():
-                if line.strip():
-                    try:
-                        data = json.loads(line)
-                        if "response" in data:
-                            combined_response += data["response"]
-                    except json.JSONDecodeError:
-                        continue
-
-            return {"response": combined_response}
+        }
+        
+        response = await client.post("/api/generate", content=orjson.dumps(payload), headers=JSON_HEADERS)
 
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=f"Error de comunicación con el servidor LLM: {e}")
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Error de comunicación con el servidor LLM: {e}")
+
+    return Response(
+        content=response.content,
+        status_code=response.status_code,
+        media_type=response.headers.get("content-type", "application/json"),
+    )
 
 # Los endpoints permanecen iguales
 @app.post("/api/generate")
 async def generate_text(query: Query):
+    if MAX_PROMPT_TOKENS and app.state.estimate_tokens(query.prompt) > MAX_PROMPT_TOKENS:
+        raise HTTPException(status_code=413, detail=f"El prompt supera el límite de {MAX_PROMPT_TOKENS} tokens")
     if query.stream:
+        upstream = await open_generation_stream(query.prompt, query.model)
         return StreamingResponse(
-            stream_generated_text(query.prompt, query.model),
-            media_type="text/plain"
+            coalesce(
+                stream_generated_text(upstream, query.raw),
+                max_bytes=BATCH_BYTES if query.batch_bytes is None else query.batch_bytes,
+                max_delay=(BATCH_MS if query.batch_ms is None else query.batch_ms) / 1000,
+            ),
+            media_type="application/x-ndjson" if query.raw else "text/plain; charset=utf-8",
+            # Cierra el stream aunque el generador no llegue a ejecutarse
+            background=BackgroundTask(upstream.aclose),
         )
     else:
-        response = await get_generated_text(query.prompt, query.model)
-        return JSONResponse(response)
+        return await get_generated_text(query.prompt, query.model)
 
 @app.post("/api/models/download")
 async def download_model(llm_name: str = Body(..., embed=True)):
-    url = f"{LLM_SERVER_URL}/api/pull"
+    global _models_cache
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json={"name": llm_name})
-            response.raise_for_status()
-            return {"message": f"Model {llm_name} downloaded successfully"}
+        response = await app.state.http.post("/api/pull", content=orjson.dumps({"name": llm_name}), headers=JSON_HEADERS)
     except httpx.RequestError as e:
         raise HTTPException(status_code=500, detail=f"Error al descargar el modelo: {e}")
+    if response.status_code >= 400:
+        raise HTTPException(status_code=response.status_code, detail=f"Error al descargar el modelo: {response.content[:512].decode('utf-8', 'replace')}")
+    _models_cache = None
+    return {"message": f"Model {llm_name} downloaded successfully"}
 
 @app.get("/api/models")
 async def list_models():
-    url = f"{LLM_SERVER_URL}/api/tags"
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            return {"models": response.json()["models"]}
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=500, detail=f"Error al obtener la lista de modelos: {e}")
+    global _models_cache
+    if _models_cache is not None and time.monotonic() - _models_cache[0] < MODELS_CACHE_TTL:
+        return Response(content=_models_cache[1], media_type="application/json")
+
+    # Solo una petición refresca la caché; el resto espera y reutiliza el resultado
+    async with _models_lock:
+        if _models_cache is not None and time.monotonic() - _models_cache[0] < MODELS_CACHE_TTL:
+            return Response(content=_models_cache[1], media_type="application/json")
+
+        try:
+            response = await app.state.http.get("/api/tags")
+        except httpx.RequestError as e:
+            raise HTTPException(status_code=500, detail=f"Error al obtener la lista de modelos: {e}")
+        if response.status_code >= 400:
+            raise HTTPException(status_code=response.status_code, detail=f"Error al obtener la lista de modelos: {response.content[:512].decode('utf-8', 'replace')}")
+
+        _models_cache = (time.monotonic(), response.content)
+        return Response(content=response.content, media_type="application/json")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=3335)
\ No newline at end of file
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=3335,
+        backlog=2048,
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count(),
+        log_level="warning",
+    )
@@ -0,0 +1,55 @@
+import orjson
+
+from fast_ndjson import Framer, extract_response, response_field
+
+
+def line(**fields):
+    return orjson.dumps(fields)
+
+
+def test_extract_plain_value():
+    assert extract_response(line(model="m", response="hola", done=False)) == b"hola"
+
+
+def test_extract_escaped_quote():
+    assert extract_response(line(response='di "hola"')) == 'di "hola"'.encode()
+
+
+def test_extract_trailing_backslash():
+    assert extract_response(line(response="C:\\", done=False)) == b"C:\\"
+
+
+def test_extract_unicode_escape():
+    assert extract_response(b'{"response":"\\u00e9\\u003c"}') == "é<".encode()
+
+
+def test_extract_missing_field():
+    assert extract_response(line(done=True)) is None
+
+
+def test_response_field_spaced_fallback():
+    assert response_field(b'{ "response": "x" }') == b"x"
+
+
+def test_response_field_ignores_non_objects():
+    assert response_field(b"123") is None
+    assert response_field(b'"response"') is None
+    assert response_field(b'["response"]') is None
+    assert response_field(b'{"response":null}') is None
+    assert response_field(b"no es json") is None
+
+
+def test_framer_joins_lines_split_across_chunks():
+    framer = Framer()
+    data = line(response="hola") + b"\n" + line(response="é adiós") + b"\n" + line(response="fin")
+    out = []
+    for i in range(0, len(data), 3):
+        out += framer.feed(data[i:i + 3])
+    out += framer.flush()
+    assert out == [b"hola", "é adiós".encode(), b"fin"]
+
+
+def test_framer_skips_empty_and_invalid_lines():
+    framer = Framer()
+    out = framer.feed(b'\n{"response":""}\nbasura\n{"done":true}\n' + line(response="a") + b"\n")
+    assert out + framer.flush() == [b"a"]
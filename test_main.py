@@ -0,0 +1,111 @@
+import asyncio
+
+import anyio
+import httpx
+
+import main
+
+
+async def chunks(items, closed, delay=0.0):
+    try:
+        for item in items:
+            if delay:
+                await asyncio.sleep(delay)
+            yield item
+    finally:
+        closed.append(True)
+
+
+async def collect(gen):
+    return [chunk async for chunk in gen]
+
+
+def test_coalesce_flushes_by_size():
+    closed = []
+    out = asyncio.run(collect(main.coalesce(chunks([b"ab", b"cd", b"ef", b"g"], closed), max_bytes=4, max_delay=60)))
+    assert out == [b"abcd", b"efg"]
+    assert closed == [True]
+
+
+def test_coalesce_flushes_by_deadline():
+    closed = []
+    gen = chunks([b"a", b"b", b"c"], closed, delay=0.05)
+    out = asyncio.run(collect(main.coalesce(gen, max_bytes=1024, max_delay=0.01)))
+    assert out == [b"a", b"b", b"c"]
+
+
+def test_coalesce_zero_limits_send_each_chunk():
+    items = [b"a", b"b", b"c"]
+    assert asyncio.run(collect(main.coalesce(chunks(items, []), max_bytes=0, max_delay=60))) == items
+    assert asyncio.run(collect(main.coalesce(chunks(items, []), max_bytes=1024, max_delay=0))) == items
+
+
+def test_coalesce_closes_wrapped_generator_on_aclose():
+    closed = []
+
+    async def run():
+        gen = main.coalesce(chunks([b"x"] * 100, closed, delay=0.001), max_bytes=1, max_delay=60)
+        assert await gen.__anext__() == b"x"
+        await gen.aclose()
+        # Antes de que asyncio.run finalice los generadores pendientes
+        assert closed == [True]
+
+    asyncio.run(run())
+
+
+def test_coalesce_closes_wrapped_generator_on_cancel():
+    closed = []
+    received = []
+
+    async def consume():
+        gen = main.coalesce(chunks([b"x"] * 1000, closed, delay=0.001), max_bytes=1024, max_delay=0.005)
+        try:
+            async for chunk in gen:
+                received.append(chunk)
+        finally:
+            await gen.aclose()
+
+    async def run():
+        # Simula la desconexión del cliente cancelando el ámbito del consumidor
+        with anyio.move_on_after(0.05):
+            await consume()
+        assert received
+        assert closed == [True]
+
+    asyncio.run(run())
+
+
+def test_generate_returns_upstream_error_status():
+    def handler(request):
+        return httpx.Response(404, json={"error": "model 'bad' not found"})
+
+    async def run():
+        main.app.state.http = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://llm")
+        try:
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.post("/api/generate", json={"prompt": "hola", "model": "bad"})
+        finally:
+            await main.app.state.http.aclose()
+
+    response = asyncio.run(run())
+    assert response.status_code == 404
+    assert "model 'bad' not found" in response.json()["detail"]
+
+
+def test_generate_streams_response_fields():
+    def handler(request):
+        return httpx.Response(200, content=b'{"response":"Ho"}\n{"response":"la"}\n{"response":"","done":true}\n')
+
+    async def run():
+        main.app.state.http = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://llm")
+        try:
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.post("/api/generate", json={"prompt": "hola"})
+        finally:
+            await main.app.state.http.aclose()
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    assert response.text == "Hola"
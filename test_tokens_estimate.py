@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip("numba")
+
+from tokens_estimate import estimate_tokens
+
+
+def test_empty_and_whitespace():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens(" \n\t ") == 0
+
+
+def test_words_count_one_token_per_four_bytes():
+    assert estimate_tokens("hola") == 1
+    assert estimate_tokens("hello world") == 4
+    assert estimate_tokens("internationalization") == 5
+
+
+def test_punctuation_counts_one_token_each():
+    assert estimate_tokens("a,b,c,d,e,f") == 11
+    assert estimate_tokens('{"k":[1,2,3]}') == 13
+
+
+def test_non_ascii_bytes_are_part_of_words():
+    assert estimate_tokens("é") == 1
+    assert estimate_tokens("¿Qué tal?") == 4
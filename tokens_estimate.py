@@ -0,0 +1,46 @@
+"""
+Estimación aproximada del número de tokens de un prompt.
+
+El bucle se compila a código nativo con numba (`numba.njit(cache=True)`
+guarda el resultado en disco para los siguientes arranques). main.py solo
+importa este módulo cuando MAX_PROMPT_TOKENS está definido, así que numba y
+numpy solo son necesarios en ese caso.
+"""
+try:
+    import numba
+    import numpy as np
+except ImportError as e:
+    raise ImportError("MAX_PROMPT_TOKENS requiere numba y numpy: pip install numba numpy") from e
+
+
+@numba.njit(cache=True)
+def _estimate(buf) -> int:
+    """
+    Cuenta un token por cada racha de letras, dígitos o bytes UTF-8 (más uno
+    por cada 4 bytes adicionales de la racha) y uno por cada signo de
+    puntuación. Los espacios y caracteres de control no cuentan.
+    """
+    tokens = 0
+    run = 0
+    for byte in buf:
+        if (
+            byte >= 0x80
+            or 0x30 <= byte <= 0x39
+            or 0x41 <= byte <= 0x5A
+            or 0x61 <= byte <= 0x7A
+        ):
+            if run % 4 == 0:
+                tokens += 1
+            run += 1
+        else:
+            run = 0
+            if byte > 0x20:
+                tokens += 1
+    return tokens
+
+
+def estimate_tokens(prompt: str) -> int:
+    """
+    Devuelve una estimación del número de tokens de prompt.
+    """
+    return int(_estimate(np.frombuffer(prompt.encode("utf-8"), np.uint8)))